@@ -83,6 +83,15 @@ class TestTMap(TestCase):
             self.assertEqual(n, TMap.n_from_size(size))
             # check bad size raises
             self.assertRaises(ValueError, lambda: TMap.n_from_size(size + 1))
+        # integral floats
+        self.assertEqual(6, TMap.n_from_size(21.0))
+        self.assertEqual(6, TMap.n_from_size(np.float64(21)))
+        self.assertRaises(ValueError, lambda: TMap.n_from_size(21.5))
+        self.assertRaises(ValueError, lambda: TMap.n_from_size(22.0))
+        # arrays
+        n = np.arange(1, 100)
+        assert_array_equal(n, TMap.n_from_size(TMap.size_from_n(n)))
+        self.assertRaises(ValueError, lambda: TMap.n_from_size(TMap.size_from_n(n) + 1))
 
     def test_copy(self):
         n = 10
@@ -122,6 +131,9 @@ class TestTMap(TestCase):
             for depth in range(n):
                 t = self.get_tmap(depth, multi_dim=n_dims)
                 assert_array_equal(t.arr, tri_n.top(depth).arr)
+            # depths beyond the bottom return the whole map
+            assert_array_equal(tri_n.arr, tri_n.top(n).arr)
+            assert_array_equal(tri_n.arr, tri_n.top(n + 1).arr)
 
     def test_level(self):
         for n in np.random.randint(3, 20, 100):
@@ -133,6 +145,11 @@ class TestTMap(TestCase):
                     end = start + width
                     self.assertEqual(n - depth, tri.level(start, end))
             self.assertRaises(TypeError, lambda: tri.level(1, 2, 3))
+            # single linear indices are plain integers
+            self.assertIs(int, type(tri.linear_from_start_end(0, n)))
+            self.assertIs(int, type(tri.linear_from_start_end(np.int64(0), np.int64(n))))
+            for idx in tri.linear_start_end_from_level(1):
+                self.assertIs(int, type(idx))
 
     def test_get_set_single_values(self):
         n = 10
@@ -161,6 +178,13 @@ class TestTMap(TestCase):
             self.assertRaises(IndexError, lambda: tri[-1, 2])
             self.assertRaises(IndexError, lambda: tri[0, n + 1])
             self.assertRaises(IndexError, lambda: tri[2, 2])
+            # non-integer indices are rejected
+            self.assertRaises(TypeError, lambda: tri[1.0, 3.0])
+            self.assertRaises(TypeError, lambda: tri[np.array([1.0]), np.array([3.0])])
+
+            def set_float():
+                tri[1.0, 3.0] = 0
+            self.assertRaises(TypeError, set_float)
 
     def test_get_submaps(self):
         n = 10
@@ -197,6 +221,19 @@ class TestTMap(TestCase):
                 self.assertRaises(IndexError, lambda: tri[-1, 2])
                 self.assertRaises(IndexError, lambda: tri[0, n + 1])
                 self.assertRaises(IndexError, lambda: tri[2, 2])
+                self.assertRaises(IndexError, lambda: tri[0:n + 1])
+                self.assertRaises(IndexError, lambda: tri[2:2])
+
+    def test_large_submaps(self):
+        # wide sub-maps of numpy arrays are copied row by row, compare to gathering from a list
+        n = 600
+        for n_dims in [None, 2]:
+            tri = self.get_tmap(n, multi_dim=n_dims)
+            tri_list = TMap(list(tri.arr))
+            for start, end in [(0, n), (30, 570), (0, 520)]:
+                sub = tri[start:end]
+                self.assertEqual(tri.arr.dtype, sub.arr.dtype)
+                assert_array_equal(np.array(tri_list[start:end].arr), sub.arr)
 
     def test_slices(self):
         n = 10
@@ -207,6 +244,16 @@ class TestTMap(TestCase):
                     arr = np.concatenate([np.array(arr)[:, None]] * n_dims, axis=-1)
                 assert_array_equal(arr, tri.lslice[level])
                 assert_array_equal(arr, tri.dslice[depth])
+            # level 0 / depth n is empty, levels/depths outside the map raise
+            self.assertEqual(0, len(tri.dslice[n]))
+            self.assertEqual(0, len(tri.lslice[0]))
+            for depth in [-1, n + 1]:
+                self.assertRaises(IndexError, lambda: tri.dslice[depth])
+                self.assertRaises(IndexError, lambda: tri.lslice[n - depth])
+
+                def set_dslice():
+                    tri.dslice[depth] = 0
+                self.assertRaises(IndexError, set_dslice)
 
     def test_print(self):
         n = 10
@@ -632,6 +679,33 @@ class TestTMap(TestCase):
                 tri.eslice[end] = exp_val + 4
                 assert_array_equal(exp_val + 4, tri.eslice[end])
             self.assertEqual(n - 1, counter)
+            # check out of bound
+            self.assertRaises(IndexError, lambda: tri.sslice[-1])
+            self.assertRaises(IndexError, lambda: tri.eslice[-1])
+            self.assertRaises(IndexError, lambda: tri.eslice[n + 1])
+
+            def set_sslice():
+                tri.sslice[-1] = 0
+
+            def set_eslice():
+                tri.eslice[-1] = 0
+
+            self.assertRaises(IndexError, set_sslice)
+            self.assertRaises(IndexError, set_eslice)
+
+        # single elements from slices of containers without advanced indexing
+        tri = self.get_tmap(n)
+        for tri_ in [TMap(list(tri.arr)), TMap({idx: val for idx, val in enumerate(tri.arr)}, _n=n)]:
+            for start in range(n):
+                for k in range(n - start):
+                    self.assertEqual(tri[start, start + 1 + k], tri_.sslice[start, k])
+            for end in range(1, n + 1):
+                for k in range(end):
+                    self.assertEqual(tri[k, end], tri_.eslice[end, k])
+            tri_.sslice[0, 2] = -1
+            self.assertEqual(-1, tri_[0, 3])
+            tri_.eslice[3, 1] = -2
+            self.assertEqual(-2, tri_[1, 3])
 
     def test_se_blocks(self):
         for linearise in [False, True]:
@@ -709,6 +783,31 @@ class TestTMap(TestCase):
                         assert_array_equal(end_block + 2, tri.eblock[level])
                         tri.eblock[level] = end_block
 
+    def test_se_blocks_pytorch(self):
+        n = 10
+        for linearise in [False, True]:
+            for n_dims in [None, 2]:
+                tri_np = self.get_tmap(n, linearise, multi_dim=n_dims)
+                tri_pt = TMap(torch.from_numpy(tri_np.arr.copy()), linearise_blocks=linearise)
+                for level in range(1, n + 1):
+                    # indices are computed as tensors
+                    linear_indices, _ = tri_pt._get_sblock_index(level)
+                    self.assertIsInstance(linear_indices, torch.Tensor)
+                    linear_indices, _ = tri_pt._get_eblock_index(level)
+                    self.assertIsInstance(linear_indices, torch.Tensor)
+                    # values are the same as for numpy
+                    assert_array_equal(tri_np.sblock[level], tri_pt.sblock[level])
+                    assert_array_equal(tri_np.eblock[level], tri_pt.eblock[level])
+                    assert_array_equal(tri_np.sblock[level, 1:-1, 1:-1], tri_pt.sblock[level, 1:-1, 1:-1])
+                    assert_array_equal(tri_np.eblock[level, 1:-1, 1:-1], tri_pt.eblock[level, 1:-1, 1:-1])
+                    # setting values
+                    block = tri_pt.sblock[level]
+                    if linearise:
+                        block = block.reshape((-1,) + tri_pt.value_shape)
+                    tri_pt.sblock[level] = block + 1
+                    tri_np.sblock[level] = block.numpy() + 1
+                    assert_array_equal(tri_np.arr, tri_pt.arr)
+
     def test_flatten(self):
         n = 10
         for n_dims in [None, 1, 2]:
@@ -788,6 +887,10 @@ class TestTMap(TestCase):
             test([reversed(l) for l in reversed(end_slices)], '-e-s')
             test([reversed(l) for l in end_slices], 'e-s')
             test([reversed(l) for l in end_slices], '+e-s')
+            # modifying the returned values does not affect the (cached) reordering
+            flat = tri_np.flatten()
+            flat += 1
+            test(level_slices)
 
     def test_reindex_top_down_start_end(self):
         seq = np.arange(10)
@@ -1,13 +1,140 @@
 #  Copyright (c) 2022 Robert Lieck.
 
 import re
+import math
+import numbers
 from copy import deepcopy
+from functools import lru_cache
 from collections import defaultdict
 
 import torch
 import numpy as np
 
 
+def _linear_from_start_end(n, start, end):
+    """
+    Check and convert a scalar (start, end) pair to the linear index in a map of width ``n``. This is the fast path
+    used by :meth:`TMap.__getitem__` and :meth:`TMap.__setitem__` for plain integers, which avoids going through
+    :meth:`TMap._check` and :meth:`TMap.linear_from_start_end`.
+
+    :param n: width of the map
+    :param start: start index (int)
+    :param end: end index (int)
+    :return: linear index
+    """
+    if not 0 <= start < end <= n:
+        raise IndexError(f"Invalid indices for TMap with size n={n}\nstart: {start}\nend: {end}")
+    depth = n - (end - start)
+    return (depth * (depth + 1) >> 1) + start
+
+
+# minimum width of a sub-map (numpy arrays, step 1) from which rows are copied one by one instead of gathered
+_min_row_copy_width = 512
+
+
+@lru_cache(maxsize=32)
+def _index_tables(n):
+    """
+    Compute the linear index of the first element at each depth (i.e. :math:`depth (depth + 1) / 2`) and the range
+    of all start/end indices 0, ..., n for a map of width ``n``. The results are cached and shared between maps, so
+    they are read-only.
+
+    :param n: width of the map
+    :return: read-only integer arrays (row offsets, index range), both of length n + 1
+    """
+    index_range = np.arange(n + 1)
+    row_offset = index_range * (index_range + 1) >> 1
+    index_range.setflags(write=False)
+    row_offset.setflags(write=False)
+    return row_offset, index_range
+
+
+# functions to copy the underlying storage in TMap.copy
+_copy_funcs = {
+    np.ndarray: np.ndarray.copy,
+    torch.Tensor: lambda t: t.detach().clone(),
+    list: list,
+    tuple: tuple,
+}
+
+
+# maximum number of elements of a map for which the flatten permutation is cached (each entry uses 8 bytes/element)
+_max_cached_flatten_size = 2 ** 20
+
+
+def _concat_ranges(first, counts, step):
+    """
+    Concatenate the arithmetic ranges ``first[i], first[i] + step, ...`` of length ``counts[i]`` into a single array,
+    using a single :func:`numpy.repeat` instead of a Python loop.
+
+    :param first: first value of each range
+    :param counts: length of each range
+    :param step: common step of all ranges
+    :return: integer array of length ``sum(counts)``
+    """
+    offsets = np.cumsum(counts) - counts
+    out = np.repeat(first - step * offsets, counts)
+    out += np.arange(0, step * len(out), step)
+    return out
+
+
+def _flatten_perm(n, outer_dim, reverse_outer, inner_dim, reverse_inner):
+    """
+    Compute the linear indices that reorder the underlying array of a map of width ``n`` as specified for
+    :meth:`TMap.flatten`. For a fixed outer index, the depths (and linear indices) along the inner dimension form an
+    arithmetic range, so the permutation is built in closed form. The result is read-only, so it can be cached (see
+    :func:`_cached_flatten_perm`).
+
+    :param n: width of the map
+    :param outer_dim: outer dimension ('s', 'e', or 'l')
+    :param reverse_outer: whether to reverse the outer dimension
+    :param inner_dim: inner dimension ('s', 'e', or 'l')
+    :param reverse_inner: whether to reverse the inner dimension
+    :return: read-only integer array of linear indices
+    """
+    row_offset = _index_tables(n)[0]
+    if outer_dim == 'l':
+        # inner dimension is start: contiguous rows of the underlying array
+        level = np.arange(1, n + 1)
+        if reverse_outer:
+            level = level[::-1]
+        depth = n - level
+        if reverse_inner:
+            perm = _concat_ranges(row_offset[depth] + depth, depth + 1, -1)
+        else:
+            perm = _concat_ranges(row_offset[depth], depth + 1, 1)
+    elif outer_dim == 's':
+        # inner dimension is end: depth runs from n - 1 (end = start + 1) down to start (end = n)
+        start = np.arange(n)
+        if reverse_outer:
+            start = start[::-1]
+        counts = n - start
+        if reverse_inner:
+            depth = _concat_ranges(start, counts, 1)
+        else:
+            depth = _concat_ranges(np.full(n, n - 1), counts, -1)
+        perm = row_offset[depth]
+        perm += np.repeat(start, counts)
+    else:
+        # inner dimension is start: depth runs from n - end (start = 0) up to n - 1 (start = end - 1)
+        end = np.arange(1, n + 1)
+        if reverse_outer:
+            end = end[::-1]
+        if reverse_inner:
+            depth = _concat_ranges(np.full(n, n - 1), end, -1)
+        else:
+            depth = _concat_ranges(n - end, end, 1)
+        perm = row_offset[depth]
+        perm += depth
+        perm -= np.repeat(n - end, end)
+    perm.setflags(write=False)
+    return perm
+
+
+# cached version of _flatten_perm (only used for maps with up to _max_cached_flatten_size elements)
+_cached_flatten_perm = lru_cache(maxsize=8)(_flatten_perm)
+
+
 class TMap:
     """
     A wrapper around a 1D array that provides access in triangular (or ternary) coordinates. A 1D array of length
@@ -83,6 +210,21 @@ class TMap:
         else:
             return int(i)
 
+    @classmethod
+    def _is_integer(cls, i):
+        """
+        Check whether i is an integer or an array/tensor of integer type.
+
+        :param i: index or array of indices
+        :return: True if i is of integer type
+        """
+        if isinstance(i, (np.ndarray, np.generic)):
+            return np.issubdtype(i.dtype, np.integer)
+        elif isinstance(i, torch.Tensor):
+            return not (i.is_floating_point() or i.is_complex())
+        else:
+            return isinstance(i, numbers.Integral)
+
     @classmethod
     def _unpack_item(cls, item):
         if isinstance(item, tuple):
@@ -99,7 +241,7 @@ class TMap:
         :param n: Width (number of entries at the bottom of the map)
         :return: Length of underlying 1D array (total number of entries in the map)
         """
-        return cls._to_int((n * (n + 1)) / 2)
+        return cls._to_int(n * (n + 1) // 2)
 
     @classmethod
     def n_from_size(cls, n):
@@ -112,10 +254,16 @@ class TMap:
         :param n: size of the underlying 1D array
         :return: width of the map
         """
-        n_ = (np.sqrt(8 * n + 1) - 1) / 2
-        if cls.size_from_n(np.floor(n_)) != n:
+        if isinstance(n, np.ndarray):
+            n_ = ((np.sqrt(8 * n + 1) - 1) / 2).astype(int)
+        elif n != int(n):
+            raise ValueError(f"{n} is not a valid size for a triangular map (not an integer)")
+        else:
+            # exact integer square root (also for integral floats)
+            n_ = (math.isqrt(8 * int(n) + 1) - 1) >> 1
+        if np.any(n_ * (n_ + 1) // 2 != n):
             raise ValueError(f"{n} is not a valid size for a triangular map (n={n_})")
-        return cls._to_int(np.floor(n_))
+        return n_
 
     @classmethod
     def get_reindex_from_start_end_to_top_down(cls, n):
@@ -127,8 +275,8 @@ class TMap:
         :param n: width of map
         :return: index array of length :math:`n (n + 1)) / 2`
         """
-        n_elem = np.arange(n + 1)
-        idx_shift = n * (n + 1) // 2 - np.flip(n_elem * (n_elem + 1) // 2)
+        n_elem = np.arange(n, -1, -1)
+        idx_shift = n * (n + 1) // 2 - n_elem * (n_elem + 1) // 2
         index_list = []
         for idx in range(1, n + 1):
             index_list.append(idx_shift[:idx] + (n - idx))
@@ -191,7 +339,7 @@ class TMap:
         sum_elem = n_elem * (n_elem + 1) // 2
         index_list = []
         for idx in range(n):
-            index_list.append(np.flip(sum_elem[idx:n] + idx))
+            index_list.append(sum_elem[idx:n][::-1] + idx)
         return np.concatenate(index_list)
 
     @classmethod
@@ -243,7 +391,13 @@ class TMap:
             self._n = self.n_from_size(len(arr))
         else:
             self._n = _n
+        # linear index of the first element at each depth and all start/end indices 0, ..., n (read-only and shared
+        # between maps of the same size, slices of the index range are handed out as views)
+        self._row_offset, self._index_range = _index_tables(self._n)
         self._arr = arr
+        # backend of the underlying storage (determined once instead of on every access)
+        self._pytorch = isinstance(arr, torch.Tensor)
+        self._advanced_indexing = self._pytorch or isinstance(arr, np.ndarray)
         try:
             self._value_shape = self._arr.shape[1:]
         except AttributeError:
@@ -331,21 +485,46 @@ class TMap:
         return self._eblock
 
     def _is_pytorch(self):
-        return isinstance(self.arr, torch.Tensor)
+        return self._pytorch
+
+    def _arange(self, *args):
+        """
+        Like np.arange but returns a tensor on the same device if the underlying array is a pytorch tensor, so that
+        index computations do not require copying between host and device.
+        """
+        if self._is_pytorch():
+            return torch.arange(*args, device=self.arr.device)
+        else:
+            return np.arange(*args)
+
+    def _gather(self, linear_indices):
+        """
+        Get the values at the given linear indices (a single index, index array or slice) of the underlying array
+        without any bounds checks. This is used internally where indices are valid by construction, while
+        :meth:`__getitem__` remains the checked public path. Containers that do not support advanced indexing (e.g.
+        lists) are indexed element-wise.
+
+        :param linear_indices: single index, index array or slice
+        :return: values
+        """
+        if self._advanced_indexing or isinstance(linear_indices, slice) or np.ndim(linear_indices) == 0:
+            return self.arr[linear_indices]
+        else:
+            return [self.arr[idx] for idx in linear_indices]
 
     def _check(self, start, end):
         """
         Check whether 0 <= start < end < n. This function also works with arrays, in which case all start/end values
-        have to pass the check. If the check is not passed, an IndexError is raised
+        have to pass the check. If the check is not passed, an IndexError is raised. Non-integer indices raise a
+        TypeError.
 
         :param start: start index or array of indices
         :param end: end index or array of indices
         """
+        if not (self._is_integer(start) and self._is_integer(end)):
+            raise TypeError(f"TMap indices must be integers or integer arrays\nstart: {start}\nend: {end}")
         if isinstance(start, np.ndarray) or isinstance(end, np.ndarray):
-            c = start < end
-            c = np.logical_and(c, 0 <= start)
-            c = np.logical_and(c, end <= self.n)
-            do_raise = not np.all(c)
+            do_raise = not np.all((0 <= start) & (start < end) & (end <= self.n))
         else:
             do_raise = not (0 <= start < end <= self.n)
         if do_raise:
@@ -387,9 +566,17 @@ class TMap:
         :param end: end index or array of indices
         :return: linear index or array of linear indices
         """
-        depth = self.depth(start, end)
-        level = self.level(depth)
-        return self._to_int(depth * (depth + 1) / 2 + end - level)
+        # equivalent to depth * (depth + 1) / 2 + end - level with level = end - start
+        depth = self.n - (end - start)
+        if isinstance(depth, np.ndarray):
+            return self._row_offset[depth] + start
+        elif isinstance(depth, torch.Tensor):
+            # compute directly to stay on the tensor's device
+            return (depth * (depth + 1) >> 1) + start
+        else:
+            # plain integer for single indices
+            depth = int(depth)
+            return (depth * (depth + 1) >> 1) + int(start)
 
     def __getitem__(self, item):
         """
@@ -401,31 +588,42 @@ class TMap:
         """
         if isinstance(item, slice):
             # return sub-map
-            # function to concatenate slices
-            if isinstance(self.arr, np.ndarray):
-                cat = np.concatenate
-            elif self._is_pytorch():
-                cat = torch.cat
-            else:
-                cat = lambda ls: sum(ls, [])
-            # star/end and depth to start with
             start = item.start
             end = item.stop
-            step = item.step
-            start_depth = self.depth(start, end)
-            # get new array of sub-map by concatenating slices
-            arr_tuple = tuple(
-                self.dslice[d][slice(start, start + (d - start_depth) + 1, step)] for d in range(start_depth, self.n)
-            )
-            arr = cat(arr_tuple)
-            # return new TMap
-            return TMap(arr, linearise_blocks=self.linearise_blocks)
+            step = 1 if item.step is None else item.step
+            self._check(start, end)
+            if step <= 0:
+                raise ValueError(f"Slicing a sub-map requires a positive step but got {step}")
+            # the sub-map has width end - start, its k-th row lies at depth start_depth + k of this map and (for
+            # step 1) contains the k + 1 elements starting at index start in that row
+            start_depth = self.n - (end - start)
+            if step == 1 and isinstance(self.arr, np.ndarray) and end - start >= _min_row_copy_width:
+                # for long rows, copying contiguous rows into a pre-allocated buffer is faster than a gather
+                arr = np.empty((self.size_from_n(end - start),) + self.value_shape, dtype=self.arr.dtype)
+                offset = 0
+                for k, linear_start in enumerate(self._row_offset[start_depth:self.n] + start):
+                    arr[offset:offset + k + 1] = self.arr[linear_start:linear_start + k + 1]
+                    offset += k + 1
+                return TMap(arr, linearise_blocks=self.linearise_blocks)
+            rows = np.arange(end - start)
+            row_sizes = rows // step + 1
+            # position of the first element of each row in the sub-map
+            sub_offsets = np.cumsum(row_sizes) - row_sizes
+            # within each row, linear indices increase by step, so they are a single arange (over all elements of the
+            # sub-map) plus a per-row shift
+            row_shift = self._row_offset[start_depth:self.n] + (start - step * sub_offsets)
+            linear_indices = np.repeat(row_shift, row_sizes)
+            linear_indices += np.arange(0, step * len(linear_indices), step)
+            # get new array of sub-map with a single gather and return new TMap
+            return TMap(self._gather(linear_indices), linearise_blocks=self.linearise_blocks)
         else:
             # return element
             start, end = item
+            if isinstance(start, int) and isinstance(end, int):
+                return self.arr[_linear_from_start_end(self.n, start, end)]
             self._check(start, end)
-            linear_idx = self.linear_from_start_end(start, end)
-            return self.arr[linear_idx]
+            depth = self.n - (end - start)
+            return self.arr[(depth * (depth + 1) >> 1) + start]
 
     def __setitem__(self, key, value):
         """
@@ -436,9 +634,12 @@ class TMap:
         :value: value to set
         """
         start, end = key
-        self._check(start, end)
-        linear_idx = self.linear_from_start_end(start, end)
-        self.arr[linear_idx] = value
+        if isinstance(start, int) and isinstance(end, int):
+            self.arr[_linear_from_start_end(self.n, start, end)] = value
+        else:
+            self._check(start, end)
+            depth = self.n - (end - start)
+            self.arr[(depth * (depth + 1) >> 1) + start] = value
 
     def copy(self):
         """
@@ -447,17 +648,11 @@ class TMap:
 
         :return: Copied map.
         """
-        if isinstance(self.arr, np.ndarray):
-            copy = self.arr.copy()
-        elif self._is_pytorch():
-            copy = self.arr.detach().clone()
-        elif isinstance(self.arr, list):
-            copy = list(self.arr)
-        elif isinstance(self.arr, tuple):
-            copy = tuple(self.arr)
-        else:
-            copy = deepcopy(self.arr)
-        return TMap(arr=copy, linearise_blocks=self.linearise_blocks, _n=self._n)
+        copy_func = _copy_funcs.get(type(self.arr))
+        if copy_func is None:
+            # fall back to subclasses of the supported types or deepcopy
+            copy_func = next((f for t, f in _copy_funcs.items() if isinstance(self.arr, t)), deepcopy)
+        return TMap(arr=copy_func(self.arr), linearise_blocks=self.linearise_blocks, _n=self._n)
 
     def top(self, depth=None):
         """
@@ -470,8 +665,9 @@ class TMap:
         if depth is None:
             return self
         else:
-            start, end = self.linear_start_end_from_level(self.level(depth - 1))
-            return TMap(self.arr[:end + 1], linearise_blocks=self.linearise_blocks)
+            # the top levels are the first depth * (depth + 1) / 2 elements (at most the whole map)
+            depth = min(max(depth, 0), self.n)
+            return TMap(self.arr[:self._row_offset[depth]], linearise_blocks=self.linearise_blocks)
 
     def linear_start_end_from_level(self, level):
         """
@@ -485,6 +681,20 @@ class TMap:
         linear_end = self.linear_from_start_end(self.n - level, self.n)
         return linear_start, linear_end
 
+    def _dslice_index(self, depth):
+        """
+        Return the slice of the underlying array corresponding to the given depth, which starts at the precomputed
+        row offset and has depth + 1 elements.
+
+        :param depth: depth to use for slicing
+        :return: slice object
+        """
+        # depth n (level 0) is valid and results in an empty slice
+        if not 0 <= depth <= self.n:
+            raise IndexError(f"Invalid depth for TMap with size n={self.n}: {depth}")
+        linear_start = self._row_offset[depth]
+        return slice(linear_start, linear_start + depth + 1)
+
     def get_lslice(self, level):
         """
         Slice the map at the given level, returning a view of the values.
@@ -492,12 +702,10 @@ class TMap:
         :param level: level to use for slicing
         :return: view of the values
         """
-        linear_start, linear_end = self.linear_start_end_from_level(level)
-        return self.arr[linear_start:linear_end + 1]
+        return self._gather(self._dslice_index(self.n - level))
 
     def set_lslice(self, level, value):
-        linear_start, linear_end = self.linear_start_end_from_level(level)
-        self.arr[linear_start:linear_end + 1] = value
+        self.arr[self._dslice_index(self.n - level)] = value
 
     def get_dslice(self, depth):
         """
@@ -506,30 +714,38 @@ class TMap:
         :param depth: depth to use for slicing
         :return: view of the values
         """
-        linear_start, linear_end = self.linear_start_end_from_level(self.level(depth))
-        return self.arr[linear_start:linear_end + 1]
+        return self._gather(self._dslice_index(depth))
 
     def set_dslice(self, depth, value):
-        linear_start, linear_end = self.linear_start_end_from_level(self.level(depth))
-        self.arr[linear_start:linear_end + 1] = value
+        self.arr[self._dslice_index(depth)] = value
 
     def _end_indices_for_sslice(self, start):
         """
         Compute the end indices corresponding to a slice at the give start index.
 
         :param start: start index
-        :return: integer array of end indices
+        :return: integer array of end indices (read-only view)
         """
-        return np.arange(start + 1, self.n + 1)
+        return self._index_range[start + 1:]
 
     def _start_indices_for_eslice(self, end):
         """
         Compute the start indices corresponding to a slice at the give end index.
 
         :param end: end index
-        :return: integer array of start indices
+        :return: integer array of start indices (read-only view)
         """
-        return np.arange(0, end)
+        return self._index_range[:end]
+
+    def _get_sslice_index(self, item):
+        start, s = self._unpack_item(item)
+        # end indices are valid by construction, only the start index has to be checked
+        if start < 0:
+            raise IndexError(f"Invalid start index for TMap with size n={self.n}: {start}")
+        end_indices = self._end_indices_for_sslice(start)
+        if s is not self.UnDef:
+            end_indices = end_indices[s]
+        return self.linear_from_start_end(start, end_indices)
 
     def get_sslice(self, item):
         """
@@ -539,21 +755,23 @@ class TMap:
         :param item: start index or tuple of start index and additional indices/slices
         :return: copy of slice at start index
         """
-        start, s = self._unpack_item(item)
-        end_indices = self._end_indices_for_sslice(start)
-        if s is not self.UnDef:
-            end_indices = end_indices[s]
-        return self[start, end_indices]
+        return self._gather(self._get_sslice_index(item))
 
     def set_sslice(self, key, value):
         """
         Like get_sslice but set value instead of returning values.
         """
-        start, s = self._unpack_item(key)
-        end_indices = self._end_indices_for_sslice(start)
+        self.arr[self._get_sslice_index(key)] = value
+
+    def _get_eslice_index(self, item):
+        end, s = self._unpack_item(item)
+        # start indices are valid by construction, only the end index has to be checked
+        if not 0 <= end <= self.n:
+            raise IndexError(f"Invalid end index for TMap with size n={self.n}: {end}")
+        start_indices = self._start_indices_for_eslice(end)
         if s is not self.UnDef:
-            end_indices = end_indices[s]
-        self[start, end_indices] = value
+            start_indices = start_indices[s]
+        return self.linear_from_start_end(start_indices, end)
 
     def get_eslice(self, item):
         """
@@ -563,36 +781,25 @@ class TMap:
         :param item: end index or tuple of end index and additional indices/slices
         :return: copy of slice at end index
         """
-        end, s = self._unpack_item(item)
-        start_indices = self._start_indices_for_eslice(end)
-        if s is not self.UnDef:
-            start_indices = start_indices[s]
-        return self[start_indices, end]
+        return self._gather(self._get_eslice_index(item))
 
     def set_eslice(self, key, value):
         """
         Like get_eslice but set value instead of returning values.
         """
-        end, s = self._unpack_item(key)
-        start_indices = self._start_indices_for_eslice(end)
-        if s is not self.UnDef:
-            start_indices = start_indices[s]
-        self[start_indices, end] = value
+        self.arr[self._get_eslice_index(key)] = value
 
     def _get_sblock_index(self, item):
         level, s = self._unpack_item(item)
         if s is self.UnDef:
             s = (slice(None), slice(None))
-        start_indices = np.arange(0, self.n - level + 1)
-        end_indices = np.concatenate(
-            [np.flip(self._end_indices_for_sslice(start)[:level, None], axis=0) for start in start_indices],
-            axis=1
-        )
-        start_indices = start_indices[None, :]
+        # end indices run from start + level (top row) down to start + 1 (bottom row)
+        start_indices = self._arange(0, self.n - level + 1)[None, :]
+        end_indices = start_indices + self._arange(level, 0, -1)[:, None]
         linear_indices = self.linear_from_start_end(start_indices, end_indices)[s]
         if self.linearise_blocks:
-            index = (linear_indices.flatten(),) + tuple([slice(None)] * len(self.value_shape))
-            return linear_indices, index
+            # ravel only copies if the (possibly sliced) indices are not contiguous
+            return linear_indices, linear_indices.ravel()
         else:
             return linear_indices, self.UnDef
 
@@ -602,9 +809,9 @@ class TMap:
         """
         linear_indices, index = self._get_sblock_index(item)
         if self.linearise_blocks:
-            return self.arr[index].reshape(linear_indices.shape + self.value_shape)
+            return self._gather(index).reshape(linear_indices.shape + self.value_shape)
         else:
-            return self.arr[linear_indices]
+            return self._gather(linear_indices)
 
     def set_sblock(self, key, value):
         """
@@ -620,16 +827,13 @@ class TMap:
         level, s = self._unpack_item(item)
         if s is self.UnDef:
             s = (slice(None), slice(None))
-        end_indices = np.arange(level, self.n + 1)
-        start_indices = np.concatenate(
-            [self._start_indices_for_eslice(end)[-level:, None] for end in end_indices],
-            axis=1
-        )
-        end_indices = end_indices[None, :]
+        # start indices run from end - level (top row) up to end - 1 (bottom row)
+        end_indices = self._arange(level, self.n + 1)[None, :]
+        start_indices = end_indices - self._arange(level, 0, -1)[:, None]
         linear_indices = self.linear_from_start_end(start_indices, end_indices)[s]
         if self.linearise_blocks:
-            index = (linear_indices.flatten(),) + tuple([slice(None)] * len(self.value_shape))
-            return linear_indices, index
+            # ravel only copies if the (possibly sliced) indices are not contiguous
+            return linear_indices, linear_indices.ravel()
         else:
             return linear_indices, self.UnDef
 
@@ -639,9 +843,9 @@ class TMap:
         """
         linear_indices, index = self._get_eblock_index(item)
         if self.linearise_blocks:
-            return self.arr[index].reshape(linear_indices.shape + self.value_shape)
+            return self._gather(index).reshape(linear_indices.shape + self.value_shape)
         else:
-            return self.arr[linear_indices]
+            return self._gather(linear_indices)
 
     def set_eblock(self, key, value):
         """
@@ -674,36 +878,16 @@ class TMap:
         # check
         if (outer_dim, inner_dim) not in [('s', 'e'), ('e', 's'), ('l', 's')]:
             raise ValueError(f"Outer/inner dimension must be s/e, e/s or l/s but are {outer_dim}/{inner_dim}")
-        # collect outer slices
-        slices = []
-        if outer_dim == 's':
-            for start in range(self.n):
-                slices.append(self.sslice[start])
-        elif outer_dim == 'e':
-            for end in range(1, self.n + 1):
-                slices.append(self.eslice[end])
-        else:
-            assert outer_dim == 'l', outer_dim
-            for level in range(1, self.n + 1):
-                slices.append(self.lslice[level])
-        # adjust sign for outer dimension
-        if outer_sign == '-':
-            slices = reversed(slices)
+        # reorder underlying array
+        perm_args = (self.n, outer_dim, outer_sign == '-', inner_dim, inner_sign == '-')
+        if self.size_from_n(self.n) <= _max_cached_flatten_size:
+            perm = _cached_flatten_perm(*perm_args)
         else:
-            assert not outer_sign or outer_sign == '+', outer_sign
-        # adjust sign for inner dimension
-        if inner_sign == '-':
-            if self._is_pytorch():
-                slices = [torch.flip(s, dims=(0,)) for s in slices]
-            else:
-                slices = [np.flip(s, axis=0) for s in slices]
-        else:
-            assert not inner_sign or inner_sign == '+', inner_sign
-        # concatenate and return
+            perm = _flatten_perm(*perm_args)
         if self._is_pytorch():
-            return torch.cat(tuple(slices))
-        else:
-            return np.concatenate(tuple(slices))
+            # pytorch does not support read-only arrays, so copy into a tensor on the same device
+            perm = torch.tensor(perm, device=self.arr.device)
+        return self._gather(perm)
 
     def __repr__(self):
         return f"TMap(n={self.n}, {self.arr}, linearise_blocks={self.linearise_blocks})"
@@ -760,6 +944,10 @@ class TMap:
         # if depth axis is used, lines have to be filled
         if daxis:
             fill_lines = True
+        # get values (detach and convert pytorch tensors only once)
+        values = self.arr
+        if self._is_pytorch() and detach_pytorch:
+            values = values.detach().cpu().numpy()
         # get function to convert values to strings
         if str_func is None:
             if scf is not None:
@@ -769,13 +957,18 @@ class TMap:
                 def str_func(val):
                     return np.format_float_positional(val, **pos)
             elif rnd is not None:
-                def str_func(val):
-                    # when decimals is less or equal to zero (i.e. rounding to whole numbers)
-                    # convert to integers for more compact printing
-                    if rnd.setdefault("decimals", 0) <= 0:
-                        return str(int(np.around(val, **rnd)))
-                    else:
-                        return str(np.around(val, **rnd))
+                # when decimals is less or equal to zero (i.e. rounding to whole numbers)
+                # convert to integers for more compact printing
+                to_int = rnd.setdefault("decimals", 0) <= 0
+                if isinstance(values, np.ndarray):
+                    # round all values at once
+                    values = np.around(values, **rnd)
+
+                    def str_func(val):
+                        return str(int(val)) if to_int else str(val)
+                else:
+                    def str_func(val):
+                        return str(int(np.around(val, **rnd))) if to_int else str(np.around(val, **rnd))
             else:
                 str_func = str
         # get values as strings
@@ -790,10 +983,9 @@ class TMap:
             # cut at level
             if cut is not None and level > cut:
                 continue
-            for start in range(depth + 1):
-                val = self[start, start + level]
-                if self._is_pytorch() and detach_pytorch:
-                    val = val.detach().numpy()
+            linear_start = self._row_offset[depth]
+            for idx in range(linear_start, linear_start + depth + 1):
+                val = values[idx]
                 str_lines = str_func(val).split("\n")
                 if len(str_lines) > 1:
                     max_width = max(max_width, max(len(s) for s in str_lines))
@@ -829,20 +1021,21 @@ class TMap:
             lines_per_level = (max_width - 1) // 2 + 1
         else:
             lines_per_level = (max_width - 1) // 2 + 2
-        s = ""
+        # collect string fragments and join them at the end
+        parts = []
         # add top for cross-style
         if crosses and cut is None:
             depth_indent = fill_char * lines_per_level * (self.n - 1)
             line_indent = fill_char * (lines_per_level - 1)
             pad = depth_indent + line_indent + fill_char * (self.n * (max_lines - 1) + 1)
-            s += pad + top_cross_char
+            parts.append(pad + top_cross_char)
             if fill_lines:
-                s += pad
+                parts.append(pad)
             # add depth axis label
             if daxis:
-                s += " depth"
+                parts.append(" depth")
             if laxis:
-                s += " level"
+                parts.append(" level")
         for depth, str_slice in enumerate(str_slices):
             # level corresponding to depth
             level = self.level(depth)
@@ -856,8 +1049,8 @@ class TMap:
                 # additional indent for this line of slice
                 line_indent = fill_char * (lines_per_level - line - 1 + max_lines - 1)
                 # newline if not empty
-                if s:
-                    s += "\n"
+                if parts:
+                    parts.append("\n")
                 # spacing within and in between cells
                 if crosses:
                     within_cell_spacing = top_char * (2 * line + 1)
@@ -866,21 +1059,21 @@ class TMap:
                     within_cell_spacing = top_char * 2 * line
                     in_between_cell_spacing = bottom_char * 2 * (lines_per_level + max_lines - line - 2)
                 # add indentation
-                s += depth_indent + line_indent
+                parts.append(depth_indent + line_indent)
                 if depth > 0:
-                    s += left_border_char + within_cell_spacing + right_inner_char + in_between_cell_spacing
-                    s += (left_inner_char + within_cell_spacing + right_inner_char + in_between_cell_spacing) * (depth - 1)
-                    s += left_inner_char + within_cell_spacing + right_border_char
+                    parts.append(left_border_char + within_cell_spacing + right_inner_char + in_between_cell_spacing)
+                    parts.append((left_inner_char + within_cell_spacing + right_inner_char + in_between_cell_spacing) * (depth - 1))
+                    parts.append(left_inner_char + within_cell_spacing + right_border_char)
                 else:
-                    s += left_border_char + within_cell_spacing + right_border_char
+                    parts.append(left_border_char + within_cell_spacing + right_border_char)
                 if fill_lines:
-                    s += line_indent + depth_indent
+                    parts.append(line_indent + depth_indent)
                 # add depth axis label
                 if not crosses and depth == 0 and line == 0:
                     if daxis:
-                        s += " depth"
+                        parts.append(" depth")
                     if laxis:
-                        s += " level"
+                        parts.append(" level")
             # add line with actual content
             for sub_idx, sub_slice in enumerate(np.array(str_slice).T):
                 sub_line_indent = fill_char * (max_lines - sub_idx - 1)
@@ -894,21 +1087,21 @@ class TMap:
                         else:
                             left_border = left_border_char
                             right_border = right_border_char
-                        s += "\n" + sub_line_indent + depth_indent + left_border + padding + (padding + inner_cross_char + padding).join(sub_slice) + padding + right_border
+                        parts.append("\n" + sub_line_indent + depth_indent + left_border + padding + (padding + inner_cross_char + padding).join(sub_slice) + padding + right_border)
                     else:
-                        s += "\n" + sub_line_indent + depth_indent + left_border_char + padding + (padding + right_inner_char + in_between_fill + left_inner_char + padding).join(sub_slice) + padding + right_border_char
+                        parts.append("\n" + sub_line_indent + depth_indent + left_border_char + padding + (padding + right_inner_char + in_between_fill + left_inner_char + padding).join(sub_slice) + padding + right_border_char)
                 else:
                     in_between_fill = fill_char * (max_lines - sub_idx - 1) * 2
-                    s += "\n" + sub_line_indent + depth_indent + left_border_char + padding + (padding + right_inner_char + in_between_fill + left_inner_char + padding).join(sub_slice) + padding + right_border_char
+                    parts.append("\n" + sub_line_indent + depth_indent + left_border_char + padding + (padding + right_inner_char + in_between_fill + left_inner_char + padding).join(sub_slice) + padding + right_border_char)
                 # fill lines
                 if fill_lines:
-                    s += depth_indent
-                s += fill_char * (max_lines - sub_idx - 1)
+                    parts.append(depth_indent)
+                parts.append(fill_char * (max_lines - sub_idx - 1))
                 # add depth axis
                 if daxis:
-                    s += f" {depth}"
+                    parts.append(f" {depth}")
                 if laxis:
-                    s += f" {level}"
+                    parts.append(f" {level}")
         if haxis:
             if crosses:
                 tick_spacing = max_width + 2 * (max_lines - 1)
@@ -917,9 +1110,9 @@ class TMap:
             just_width = tick_spacing + 1
             n = self.n
             a = [str(x).ljust(just_width) for x in range(n + 1)]
-            s += "\n" + ("│" + " " * tick_spacing) * n + "│"
-            s += "\n" + "".join(a)
-        return s
+            parts.append("\n" + ("│" + " " * tick_spacing) * n + "│")
+            parts.append("\n" + "".join(a))
+        return "".join(parts)
 
 
 def _get_size_and_kwargs(n, **kwargs):